@@ -0,0 +1,61 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+# JIT-compiled scans used by the FASTA formats in `_util`. numba is an
+# optional dependency that takes a noticeable time to import, so this module
+# is only imported the first time one of these scans would be used.
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True)
+def validate_bytes_against_table(buf, table):
+    # Returns the index of the first byte of buf not allowed by table, or
+    # -1 if every byte is allowed. Blocks are AND-reduced without an early
+    # exit so the inner loop stays branch-free; only a block that contains
+    # an offending byte is rescanned to find its position.
+    n = buf.size
+    for start in range(0, n, 4096):
+        stop = min(start + 4096, n)
+        ok = 1
+        for i in range(start, stop):
+            ok &= table[buf[i]]
+        if ok == 0:
+            for i in range(start, stop):
+                if table[buf[i]] == 0:
+                    return i
+    return -1
+
+
+@numba.njit(parallel=True, cache=True)
+def find_disallowed_sequence_byte(block, table, chunk_size,
+                                  starts_in_description):
+    # Returns the offset of the first byte of block that is not on a
+    # description line and is not allowed by table, or -1 if there is
+    # none. Chunks don't start on line boundaries, so starts_in_description
+    # tells each chunk whether it begins inside a description.
+    n = block.size
+    n_chunks = (n + chunk_size - 1) // chunk_size
+    bad = np.full(n_chunks, -1, dtype=np.int64)
+    for chunk in numba.prange(n_chunks):
+        start = chunk * chunk_size
+        stop = min(start + chunk_size, n)
+        in_description = starts_in_description[chunk]
+        at_line_start = False
+        for i in range(start, stop):
+            byte = block[i]
+            if at_line_start:
+                in_description = byte == 0x3E
+            at_line_start = byte == 0x0A
+            if not in_description and table[byte] == 0:
+                bad[chunk] = i
+                break
+    for chunk in range(n_chunks):
+        if bad[chunk] != -1:
+            return bad[chunk]
+    return -1
@@ -5,36 +5,240 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
-import re
 import gzip
+import importlib.util
 import itertools
+import mmap
+import os
+import threading
+from functools import lru_cache
 
+import numpy as np
 import qiime2.plugin.model as model
 from qiime2.plugin import ValidationError
 
+# numba is optional and slow to import, so `_jit` is only imported the first
+# time one of its scans would be used.
+_NUMBA_AVAILABLE = importlib.util.find_spec('numba') is not None
+
 # These classes and their helper functions are located in this module to avoid
 # circular imports.
 
+# Sequence lines at least this long are checked with the JIT-compiled scan
+# when numba is installed. Below this, the cost of dispatching into numba
+# outweighs the scan itself and bytes.translate is faster.
+_JIT_MIN_LINE_LENGTH = 4096
+
+
+def _build_alphabet_table(alphabet_str):
+    # Byte-indexed lookup table: entry i is 1 if chr(i) is in the alphabet.
+    return bytes(1 if chr(i) in alphabet_str else 0 for i in range(256))
+
+
+def _get_jit():
+    """Return the `_jit` module, or None if numba can't be used."""
+    global _NUMBA_AVAILABLE
+    if _NUMBA_AVAILABLE:
+        try:
+            from . import _jit
+        except ImportError:
+            _NUMBA_AVAILABLE = False
+        else:
+            return _jit
+    return None
+
+
+def _is_valid_sequence(raw, ValidationBytes, ValidationTable):
+    if len(raw) >= _JIT_MIN_LINE_LENGTH:
+        jit = _get_jit()
+        if jit is not None:
+            buf = np.frombuffer(raw, dtype=np.uint8)
+            return jit.validate_bytes_against_table(
+                buf, ValidationTable) == -1
+    # Deleting every allowed byte leaves nothing behind iff the line is valid.
+    return not raw.translate(None, ValidationBytes)
+
+
+# Vectorized validation scans files in blocks of at most this many bytes,
+# ending on line boundaries, to bound its temporary arrays. A sequence line
+# longer than this is checked on its own, in pieces of this size.
+_VECTORIZED_BLOCK_SIZE = 1 << 24
+
+# With numba, blocks of at least _JIT_MIN_BLOCK_SIZE bytes are split into
+# chunks of _JIT_CHUNK_SIZE bytes that are checked in parallel. Smaller
+# blocks don't make up for the cost of starting numba's parallel runtime.
+_JIT_MIN_BLOCK_SIZE = 1 << 23
+_JIT_CHUNK_SIZE = 1 << 20
+
+# numba's default workqueue threading layer can't run parallel functions
+# from several threads at once, so calls into the parallel scan are
+# serialized.
+_JIT_PARALLEL_LOCK = threading.Lock()
+
+
+def _scan_fasta_block(block, table):
+    """Locate the description lines in a block of complete FASTA lines.
 
+    Every byte that is not on a description line must be allowed by `table`
+    (which must also allow newlines), otherwise None is returned. On success,
+    returns the start and end offsets of each description line (excluding
+    its newline), the number of sequence characters preceding each
+    description, and the total number of sequence characters in the block.
+
+    """
+    size = block.size
+    newlines = np.flatnonzero(block == 0x0A)
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_starts = line_starts[line_starts < size]
+    desc_starts = line_starts[block[line_starts] == 0x3E]
+    # Number of newlines before each description, i.e. its line index.
+    newlines_before = np.searchsorted(newlines, desc_starts)
+    desc_ends = np.append(newlines, size)[newlines_before]
+
+    jit = _get_jit() if size >= _JIT_MIN_BLOCK_SIZE else None
+    if jit is not None:
+        chunk_starts = np.arange(0, size, _JIT_CHUNK_SIZE)
+        starts_in_description = np.zeros(chunk_starts.size, dtype=np.bool_)
+        if desc_starts.size:
+            # The last description starting at or before each chunk
+            last = np.searchsorted(desc_starts, chunk_starts, side='right') - 1
+            starts_in_description = ((last >= 0)
+                                     & (chunk_starts < desc_ends[last]))
+        with _JIT_PARALLEL_LOCK:
+            bad = jit.find_disallowed_sequence_byte(
+                block, table, _JIT_CHUNK_SIZE, starts_in_description)
+        if bad != -1:
+            return None
+    else:
+        # Mark description bytes so they are exempt from the alphabet check.
+        delta = np.zeros(size + 1, dtype=np.int8)
+        delta[desc_starts] = 1
+        delta[desc_ends] = -1
+        allowed = table[block]
+        allowed |= np.cumsum(delta[:-1], dtype=np.int8).view(np.uint8)
+        if not allowed.all():
+            return None
+
+    desc_lengths = desc_ends - desc_starts
+    seq_before = (desc_starts - newlines_before
+                  - (np.cumsum(desc_lengths) - desc_lengths))
+    seq_total = size - newlines.size - desc_lengths.sum()
+    return desc_starts, desc_ends, seq_before, seq_total
+
+
+# Alphabets come from a small, fixed set and the results are read-only, so
+# they are built once and shared by every format instance.
+@lru_cache(maxsize=None)
 def _construct_validator_from_alphabet(alphabet_str):
     if alphabet_str:
-        Validator = re.compile(fr'[{alphabet_str}]+\r?\n?')
-        ValidationSet = frozenset(alphabet_str)
+        ValidationBytes = alphabet_str.encode('ascii')
+        ValidationTable = np.frombuffer(
+            _build_alphabet_table(alphabet_str), dtype=np.uint8)
     else:
-        Validator, ValidationSet = None, None
-    return Validator, ValidationSet
+        ValidationBytes, ValidationTable = None, None
+    return ValidationBytes, ValidationTable
 
 
 class FASTAFormat(model.TextFileFormat):
+    # The qiime2 format base still provides a __dict__; the slots only keep
+    # these two hot attributes out of it.
+    __slots__ = ('aligned', 'alphabet')
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.aligned = False
         self.alphabet = None
 
     def _validate_(self, level):
-        FASTAValidator, ValidationSet = _construct_validator_from_alphabet(
+        ValidationBytes, ValidationTable = _construct_validator_from_alphabet(
             self.alphabet)
-        self._validate_FASTA(level, FASTAValidator, ValidationSet)
+        if (level == 'max' and ValidationBytes
+                and self._validate_vectorized(ValidationTable)):
+            return
+        self._validate_FASTA(level, ValidationBytes, ValidationTable)
+
+    def _validate_vectorized(self, ValidationTable):
+        """Validate the whole file with NumPy instead of line by line.
+
+        Returns True only if the file is valid. Files this can't vouch for
+        (e.g. a BOM, whitespace, '\\r' line endings, invalid characters or a
+        malformed description) return False, so that `_validate_FASTA` can
+        report the exact error, if there is one.
+
+        """
+        if ValidationTable[list(b' \t\r\x0b\x0c')].any():
+            # Stripping lines would change what is validated.
+            return False
+        table = ValidationTable.copy()
+        table[0x0A] = 1
+
+        with self.path.open('rb') as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return self._validate_mmap(mm, table)
+
+    def _validate_mmap(self, mm, table):
+        buf = np.frombuffer(mm, dtype=np.uint8)
+        if buf[0] != 0x3E:
+            return False
+
+        ids = set()
+        seq_before = []
+        seq_total = 0
+        start = 0
+        while start < buf.size:
+            if start + _VECTORIZED_BLOCK_SIZE >= buf.size:
+                stop = buf.size
+            else:
+                # End the block after its last complete line.
+                stop = mm.rfind(
+                    b'\n', start, start + _VECTORIZED_BLOCK_SIZE) + 1
+            if stop == 0:
+                # The line at start is longer than a block.
+                stop = mm.find(b'\n', start + _VECTORIZED_BLOCK_SIZE)
+                stop = buf.size if stop == -1 else stop + 1
+                if buf[start] != 0x3E:
+                    for piece in range(start, stop, _VECTORIZED_BLOCK_SIZE):
+                        if not table[buf[piece:min(
+                                piece + _VECTORIZED_BLOCK_SIZE, stop)]].all():
+                            return False
+                    seq_total += stop - start - int(buf[stop - 1] == 0x0A)
+                    start = stop
+                    continue
+                # A description this long is scanned as a block of its own.
+
+            scanned = _scan_fasta_block(buf[start:stop], table)
+            if scanned is None:
+                return False
+            desc_starts, desc_ends, block_seq_before, block_seq_total = \
+                scanned
+
+            for desc_start, desc_end in zip((desc_starts + start).tolist(),
+                                            (desc_ends + start).tolist()):
+                try:
+                    description = mm[desc_start:desc_end].strip().decode(
+                        'utf-8-sig').split()
+                except UnicodeDecodeError:
+                    return False
+                if description[0] == '>' or description[0] in ids:
+                    return False
+                ids.add(description[0])
+
+            seq_before.append(block_seq_before + seq_total)
+            seq_total += block_seq_total
+            start = stop
+
+        seq_lengths = np.diff(np.append(np.concatenate(seq_before), seq_total))
+        if (seq_lengths[:-1] == 0).any():
+            # Consecutive descriptions
+            return False
+        if self.aligned and (seq_lengths.size < 2
+                             or (seq_lengths != seq_lengths[0]).any()):
+            # The line-by-line check takes its reference length from the
+            # first of at least two sequences.
+            return False
+        return True
 
     def _validate_line_lengths(
             self, seq_len, prev_seq_len, prev_seq_start_line):
@@ -45,7 +249,8 @@ class FASTAFormat(model.TextFileFormat):
                                   f'were length {seq_len}. All sequences must '
                                   'be the same length for AlignedFASTAFormat.')
 
-    def _validate_FASTA(self, level, FASTAValidator=None, ValidationSet=None):
+    def _validate_FASTA(self, level, ValidationBytes=None,
+                        ValidationTable=None):
         last_line_was_ID = False
         ids = {}
 
@@ -72,14 +277,26 @@ class FASTAFormat(model.TextFileFormat):
                                           "start with '>'")
                 fh.seek(0)
 
-                for line_number, line in enumerate(fh, 1):
-                    line = line.strip()
+                for line_number, raw in enumerate(fh, 1):
+                    raw = raw.strip()
                     if line_number >= max_lines:
                         return
-                    line = line.decode('utf-8-sig')
+                    # Valid sequence lines are plain ASCII, so only
+                    # descriptions and invalid lines need to be decoded.
+                    if (ValidationBytes and raw and raw[0] != 0x3E
+                            and _is_valid_sequence(
+                                raw, ValidationBytes, ValidationTable)):
+                        if prev_seq_start_line == 0:
+                            prev_seq_start_line = line_number
+
+                        prev_seq_len += len(raw)
+                        last_line_was_ID = False
+                        continue
+
+                    line = raw.decode('utf-8-sig')
 
                     if line.startswith('>'):
-                        if FASTAValidator and ValidationSet:
+                        if ValidationBytes:
                             if seq_len == 0:
                                 seq_len = prev_seq_len
 
@@ -115,25 +332,27 @@ class FASTAFormat(model.TextFileFormat):
                         ids[line[0]] = line_number
                         last_line_was_ID = True
 
-                    elif FASTAValidator and ValidationSet:
-                        if re.fullmatch(FASTAValidator, line):
+                    elif ValidationBytes:
+                        # Blank, or not valid before decoding
+                        for position, character in enumerate(line):
+                            code = ord(character)
+                            if code > 255 or not ValidationTable[code]:
+                                raise ValidationError(
+                                    f"Invalid character '{character}' at "
+                                    f"position {position} on line "
+                                    f"{line_number} (does not match IUPAC "
+                                    "characters for this sequence type). "
+                                    "Allowed characters are "
+                                    f"{self.alphabet}.")
+
+                        if line:
+                            # e.g. the decoder dropped a byte order mark
                             if prev_seq_start_line == 0:
                                 prev_seq_start_line = line_number
 
                             prev_seq_len += len(line)
                             last_line_was_ID = False
 
-                        else:
-                            for position, character in enumerate(line):
-                                if character not in ValidationSet:
-                                    raise ValidationError(
-                                        f"Invalid character '{character}' at "
-                                        f"position {position} on line "
-                                        f"{line_number} (does not match IUPAC "
-                                        "characters for this sequence type). "
-                                        "Allowed characters are "
-                                        f"{self.alphabet}.")
-
                     else:
                         last_line_was_ID = False
 
@@ -146,10 +365,13 @@ class FASTAFormat(model.TextFileFormat):
                 seq_len, prev_seq_len, prev_seq_start_line)
 
 
+_DNA = "ACGTRYKMSWBDHVN"
+
+
 class DNAFASTAFormat(FASTAFormat):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.alphabet = "ACGTRYKMSWBDHVN"
+        self.alphabet = _DNA
 
 
 class FastqGzFormat(model.BinaryFileFormat):
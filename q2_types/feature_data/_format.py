@@ -5,18 +5,40 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
-import re
+import csv
+from itertools import islice
 
+import numpy as np
 import pandas as pd
 import skbio
 
 import qiime2.plugin.model as model
 from qiime2.plugin import ValidationError
+from qiime2.metadata.base import is_id_header
 import qiime2
 
-from .._util import FASTAFormat, DNAFASTAFormat
+from .._util import FASTAFormat, DNAFASTAFormat, _DNA
 from ..plugin_setup import plugin
 
+# Base alphabets; the mixed-case and aligned variants are derived from these
+# and from `_DNA`.
+_RNA = "ACGURYKMSWBDHVN"
+_PROT = "ABCDEFGHIJKLMNOPQRSTUVWXYZ*"
+
+# Mixed-case alphabets are built once here rather than per format instance.
+_DNA_MIXED = _DNA + _DNA.lower()
+_RNA_MIXED = _RNA + _RNA.lower()
+_PROT_MIXED = _PROT + _PROT.replace("*", "").lower()
+
+# The same goes for the alphabets of the aligned formats.
+_ALIGNED_SUFFIX = ".-"
+_DNA_ALIGNED = _DNA + _ALIGNED_SUFFIX
+_DNA_ALIGNED_MIXED = _DNA_MIXED + _ALIGNED_SUFFIX
+_RNA_ALIGNED = _RNA + _ALIGNED_SUFFIX
+_RNA_ALIGNED_MIXED = _RNA_MIXED + _ALIGNED_SUFFIX
+_PROT_ALIGNED = _PROT + _ALIGNED_SUFFIX
+_PROT_ALIGNED_MIXED = _PROT_MIXED + _ALIGNED_SUFFIX
+
 
 class TaxonomyFormat(model.TextFileFormat):
     """Legacy format for any 2+ column TSV file, with or without a header.
@@ -45,24 +67,27 @@ class TaxonomyFormat(model.TextFileFormat):
     """
 
     def sniff(self):
-        with self.open() as fh:
-            count = 0
-            while count < 10:
-                line = fh.readline()
-
-                if line == '':
-                    # EOF
-                    break
-                elif line.lstrip(' ') == '\n':
-                    # Blank line
-                    continue
-                else:
-                    cells = line.split('\t')
-                    if len(cells) < 2:
-                        return False
-                    count += 1
-
-            return False if count == 0 else True
+        try:
+            with self.open() as fh:
+                count = 0
+                while count < 10:
+                    line = fh.readline()
+
+                    if line == '':
+                        # EOF
+                        break
+                    elif line.lstrip(' ') == '\n':
+                        # Blank line
+                        continue
+                    else:
+                        cells = line.split('\t')
+                        if len(cells) < 2:
+                            return False
+                        count += 1
+
+                return False if count == 0 else True
+        except UnicodeDecodeError:
+            return False
 
 
 TaxonomyDirectoryFormat = model.SingleFileDirectoryFormat(
@@ -98,44 +123,66 @@ class TSVTaxonomyFormat(model.TextFileFormat):
 
     """
     HEADER = ['Feature ID', 'Taxon']
+    # The header line either is exactly HEADER or continues with more columns.
+    _HEADER_EXACT = 'Feature ID\tTaxon'
+    _HEADER_PREFIX = _HEADER_EXACT + '\t'
+
+    def _undecodable_line(self):
+        # Text mode decodes ahead of the line being read, so the line that
+        # can't be decoded is only located once decoding has failed.
+        with open(str(self), 'rb') as fh:
+            for i, line in enumerate(fh, start=1):
+                try:
+                    line.decode('utf-8')
+                except UnicodeDecodeError:
+                    return i
 
     def _check_n_records(self, n=None):
+        data_line_count = 0
+        header = None
+
+        # Tracks line number for error reporting
+        i = 0
+
         with self.open() as fh:
-            data_line_count = 0
-            header = None
-
-            file_ = enumerate(fh) if n is None else zip(range(n), fh)
-
-            for i, line in file_:
-                # Tracks line number for error reporting
-                i = i + 1
-
-                if line.lstrip(' ') == '\n':
-                    # Blank line
-                    continue
-
-                cells = line.strip('\n').split('\t')
-
-                if header is None:
-                    if cells[:2] != self.HEADER:
-                        raise ValidationError(
-                            '%s must be the first two header values. The '
-                            'first two header values provided are: %s (on '
-                            'line %s).' % (self.HEADER, cells[:2], i))
-                    header = cells
-                else:
-                    if len(cells) != len(header):
-                        raise ValidationError(
-                            'Number of values on line %s are not the same as '
-                            'number of header values. Found %s values '
-                            '(%s), expected %s.' % (i, len(cells), cells,
-                                                    len(self.HEADER)))
-
-                    data_line_count += 1
-
-            if data_line_count == 0:
-                raise ValidationError('No taxonomy records found, only blank '
-                                      'lines and/or a header row.')
+            # islice stops before reading past the nth line, and reads every
+            # line when n is None.
+            try:
+                for line in islice(fh, n):
+                    i += 1
+
+                    if line.lstrip(' ') == '\n':
+                        # Blank line
+                        continue
+
+                    if header is None:
+                        header = line
+                        if not (line.startswith(self._HEADER_PREFIX)
+                                or line.rstrip('\n') == self._HEADER_EXACT):
+                            cells = line.strip('\n').split('\t')
+                            raise ValidationError(
+                                '%s must be the first two header values. The '
+                                'first two header values provided are: %s (on '
+                                'line %s).' % (self.HEADER, cells[:2], i))
+                        expected_tabs = line.count('\t')
+                    else:
+                        # Only split the line when it has to be reported.
+                        if line.count('\t') != expected_tabs:
+                            cells = line.strip('\n').split('\t')
+                            raise ValidationError(
+                                'Number of values on line %s are not the same '
+                                'as number of header values. Found %s values '
+                                '(%s), expected %s.' % (i, len(cells), cells,
+                                                        len(self.HEADER)))
+
+                        data_line_count += 1
+            except UnicodeDecodeError as e:
+                raise ValidationError('utf-8 cannot decode byte on line '
+                                      '%s' % self._undecodable_line()) from e
+
+        if data_line_count == 0:
+            raise ValidationError('No taxonomy records found, only blank '
+                                  'lines and/or a header row.')
 
     def _validate_(self, level):
         self._check_n_records(n={'min': 10, 'max': None}[level])
@@ -148,7 +195,7 @@ TSVTaxonomyDirectoryFormat = model.SingleFileDirectoryFormat(
 class AlignedFASTAFormatMixin:
     def _turn_into_alignment(self):
         self.aligned = True
-        self.alphabet = self.alphabet + ".-"
+        self.alphabet = self.alphabet + _ALIGNED_SUFFIX
 
     def _validate_line_lengths(
             self, seq_len, prev_seq_len, prev_seq_start_line):
@@ -167,7 +214,7 @@ DNASequencesDirectoryFormat = model.SingleFileDirectoryFormat(
 class MixedCaseDNAFASTAFormat(DNAFASTAFormat):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.alphabet = self.alphabet + self.alphabet.lower()
+        self.alphabet = _DNA_MIXED
 
 
 MixedCaseDNASequencesDirectoryFormat = model.SingleFileDirectoryFormat(
@@ -178,7 +225,7 @@ MixedCaseDNASequencesDirectoryFormat = model.SingleFileDirectoryFormat(
 class RNAFASTAFormat(FASTAFormat):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.alphabet = "ACGURYKMSWBDHVN"
+        self.alphabet = _RNA
 
 
 RNASequencesDirectoryFormat = model.SingleFileDirectoryFormat(
@@ -188,7 +235,7 @@ RNASequencesDirectoryFormat = model.SingleFileDirectoryFormat(
 class MixedCaseRNAFASTAFormat(RNAFASTAFormat):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.alphabet = self.alphabet + self.alphabet.lower()
+        self.alphabet = _RNA_MIXED
 
 
 MixedCaseRNASequencesDirectoryFormat = model.SingleFileDirectoryFormat(
@@ -213,7 +260,8 @@ class PairedRNASequencesDirectoryFormat(model.DirectoryFormat):
 class AlignedDNAFASTAFormat(AlignedFASTAFormatMixin, DNAFASTAFormat):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        super()._turn_into_alignment()
+        self.aligned = True
+        self.alphabet = _DNA_ALIGNED
 
 
 AlignedDNASequencesDirectoryFormat = model.SingleFileDirectoryFormat(
@@ -225,7 +273,8 @@ class MixedCaseAlignedDNAFASTAFormat(AlignedFASTAFormatMixin,
                                      MixedCaseDNAFASTAFormat):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        super()._turn_into_alignment()
+        self.aligned = True
+        self.alphabet = _DNA_ALIGNED_MIXED
 
 
 MixedCaseAlignedDNASequencesDirectoryFormat = model.SingleFileDirectoryFormat(
@@ -236,7 +285,8 @@ MixedCaseAlignedDNASequencesDirectoryFormat = model.SingleFileDirectoryFormat(
 class AlignedRNAFASTAFormat(AlignedFASTAFormatMixin, RNAFASTAFormat):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        super()._turn_into_alignment()
+        self.aligned = True
+        self.alphabet = _RNA_ALIGNED
 
 
 AlignedRNASequencesDirectoryFormat = model.SingleFileDirectoryFormat(
@@ -248,7 +298,8 @@ class MixedCaseAlignedRNAFASTAFormat(AlignedFASTAFormatMixin,
                                      MixedCaseRNAFASTAFormat):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        super()._turn_into_alignment()
+        self.aligned = True
+        self.alphabet = _RNA_ALIGNED_MIXED
 
 
 MixedCaseAlignedRNASequencesDirectoryFormat = model.SingleFileDirectoryFormat(
@@ -256,17 +307,73 @@ MixedCaseAlignedRNASequencesDirectoryFormat = model.SingleFileDirectoryFormat(
     'aligned-rna-sequences.fasta', MixedCaseAlignedRNAFASTAFormat)
 
 
-def _construct_validator_from_alphabet(alphabet_str):
-    if alphabet_str:
-        Validator = re.compile(fr'[{alphabet_str}]+\r?\n?')
-        ValidationSet = frozenset(alphabet_str)
-    else:
-        Validator, ValidationSet = None, None
-    return Validator, ValidationSet
-
-
 class DifferentialFormat(model.TextFileFormat):
+    def _is_plain_numeric_table(self):
+        """Check for a plain, finite, all-numeric table in a single read.
+
+        This covers files written by `qiime2.Metadata.save` from numeric data
+        without building a `Metadata` object. Returns False for anything
+        else (comments, missing values, whitespace, quoting, other
+        directives, invalid values, ...), which `validate` then hands to
+        `qiime2.Metadata.load` to accept or reject with its usual errors.
+
+        """
+        # Binary, so that pandas can parse the rest of the handle without
+        # Python decoding it first.
+        with open(str(self), 'rb') as fh:
+            try:
+                header = fh.readline().decode('utf-8-sig').rstrip(
+                    '\r\n').split('\t')
+                data_start = fh.tell()
+                directive = fh.readline().decode('utf-8')
+            except UnicodeDecodeError:
+                return False
+
+            if directive.startswith('#q2:types\t'):
+                types = directive.rstrip('\r\n').split('\t')[1:]
+                # Metadata rejects a directive with more non-empty cells than
+                # the header has columns.
+                if (any(t != 'numeric' for t in types[:len(header) - 1])
+                        or any(types[len(header) - 1:])):
+                    return False
+            else:
+                fh.seek(data_start)
+
+            if (not is_id_header(header[0])
+                    or len(header) < 2 or len(set(header)) != len(header)
+                    or any(not c or c != c.strip() or c.startswith('#')
+                           or is_id_header(c) for c in header[1:])):
+                return False
+
+            # The rest of the file is parsed from the same handle.
+            try:
+                df = pd.read_csv(fh, sep='\t', engine='c', encoding='utf-8',
+                                 header=None, names=header,
+                                 dtype={header[0]: str},
+                                 keep_default_na=False, na_values=[''],
+                                 quoting=csv.QUOTE_NONE,
+                                 skip_blank_lines=False)
+            except (UnicodeDecodeError, ValueError):
+                return False
+
+        if not isinstance(df.index, pd.RangeIndex):
+            # pandas took the IDs as an index because rows are too long.
+            return False
+
+        ids = df.pop(header[0])
+        if (df.empty or ids.isnull().any() or not ids.is_unique
+                or (ids.str.strip() != ids).any()
+                or ids.str.startswith('#').any()
+                or ids.map(is_id_header).any()):
+            return False
+
+        numeric = df.dtypes.apply(lambda dtype: dtype.kind in 'iuf').values
+        return bool(numeric.all() and np.isfinite(df.values).all())
+
     def validate(self, *args):
+        if self._is_plain_numeric_table():
+            return
+
         try:
             md = qiime2.Metadata.load(str(self))
         except qiime2.metadata.MetadataFileError as md_exc:
@@ -287,7 +394,7 @@ DifferentialDirectoryFormat = model.SingleFileDirectoryFormat(
 class ProteinFASTAFormat(FASTAFormat):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ*"
+        self.alphabet = _PROT
 
 
 ProteinSequencesDirectoryFormat = model.SingleFileDirectoryFormat(
@@ -299,8 +406,7 @@ ProteinSequencesDirectoryFormat = model.SingleFileDirectoryFormat(
 class MixedCaseProteinFASTAFormat(ProteinFASTAFormat):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        lower_case = "abcdefghijklmnopqrstuvwxyz"
-        self.alphabet = self.alphabet + lower_case
+        self.alphabet = _PROT_MIXED
 
 
 MixedCaseProteinSequencesDirectoryFormat = model.SingleFileDirectoryFormat(
@@ -312,7 +418,8 @@ MixedCaseProteinSequencesDirectoryFormat = model.SingleFileDirectoryFormat(
 class AlignedProteinFASTAFormat(AlignedFASTAFormatMixin, ProteinFASTAFormat):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        super()._turn_into_alignment()
+        self.aligned = True
+        self.alphabet = _PROT_ALIGNED
 
 
 AlignedProteinSequencesDirectoryFormat = model.SingleFileDirectoryFormat(
@@ -326,7 +433,8 @@ class MixedCaseAlignedProteinFASTAFormat(
 ):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        super()._turn_into_alignment()
+        self.aligned = True
+        self.alphabet = _PROT_ALIGNED_MIXED
 
 
 MixedCaseAlignedProteinSequencesDirectoryFormat = (
@@ -339,7 +447,45 @@ MixedCaseAlignedProteinSequencesDirectoryFormat = (
 
 
 class BLAST6Format(model.TextFileFormat):
-    def validate(self, *args):
+    def _looks_valid(self, n):
+        """Return whether the first `n` records pass a streaming probe.
+
+        Returns False if any of them doesn't have the 12 tab-separated
+        default columns with numeric values (or N/A) from the third column
+        on, or if the file has no records.
+
+        """
+        try:
+            # Records are read lazily, so only the first `n` of them (and
+            # the read-ahead of one buffer) are read and decoded. Undecodable
+            # files are left for skbio to reject.
+            with self.open() as fh:
+                records = list(islice(
+                    (line for line in fh if line != '\n'), n))
+        except UnicodeDecodeError:
+            return False
+
+        for record in records:
+            cells = record.rstrip('\n').split('\t')
+            if len(cells) != 12:
+                return False
+            for cell in cells[2:]:
+                if cell != 'N/A':
+                    # float() also accepts non-ASCII digits and '_'
+                    # separators, which the BLAST6 reader doesn't.
+                    if not cell.isascii() or '_' in cell:
+                        return False
+                    try:
+                        float(cell)
+                    except ValueError:
+                        return False
+
+        return bool(records)
+
+    def _validate_(self, level):
+        if level == 'min' and self._looks_valid(10):
+            return
+
         try:
             _ = skbio.read(str(self), format='blast+6', into=pd.DataFrame,
                            default_columns=True)
@@ -368,12 +514,14 @@ class SequenceCharacteristicsFormat(model.TextFileFormat):
     """
 
     def validate(self, n_records=None):
+        # Only the header is needed to count the columns
         try:
-            data = pd.read_csv(str(self), sep='\t', index_col=0)
+            header = pd.read_csv(str(self), sep='\t', index_col=0, nrows=0,
+                                 engine='c')
         except pd.errors.EmptyDataError:
             raise ValidationError('File cannot be empty.')
 
-        if not data.columns.any():
+        if header.columns.empty:
             raise ValidationError('File needs to have at least two columns.')
 
 
@@ -382,7 +530,7 @@ SequenceCharacteristicsDirectoryFormat = model.SingleFileDirectoryFormat(
     "sequence_characteristics.tsv", SequenceCharacteristicsFormat
 )
 
-plugin.register_formats(
+_ALL_FORMATS = (
     TSVTaxonomyFormat, TSVTaxonomyDirectoryFormat,
     HeaderlessTSVTaxonomyFormat, HeaderlessTSVTaxonomyDirectoryFormat,
     TaxonomyFormat, TaxonomyDirectoryFormat, DNAFASTAFormat,
@@ -404,3 +552,5 @@ plugin.register_formats(
     MixedCaseAlignedRNASequencesDirectoryFormat, SequenceCharacteristicsFormat,
     SequenceCharacteristicsDirectoryFormat
 )
+
+plugin.register_formats(*_ALL_FORMATS)
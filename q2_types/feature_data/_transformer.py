@@ -106,7 +106,9 @@ def _taxonomy_formats_to_dataframe(filepath, has_header=None):
 
 
 def _has_expected_header(df):
-    return df.iloc[0].tolist()[:2] == TSVTaxonomyFormat.HEADER
+    # Callers have already checked that there are at least two columns.
+    return (df.iat[0, 0] == TSVTaxonomyFormat.HEADER[0]
+            and df.iat[0, 1] == TSVTaxonomyFormat.HEADER[1])
 
 
 def _dataframe_to_tsv_taxonomy_format(df):
@@ -6,10 +6,15 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import importlib.util
 import os
 import os.path
 import shutil
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import numpy as np
 
 from q2_types.feature_data import (
     TaxonomyFormat, TaxonomyDirectoryFormat, HeaderlessTSVTaxonomyFormat,
@@ -162,6 +167,43 @@ class TestTaxonomyFormats(TestPluginBase):
                                         'line 2.*3 values.*expected 2'):
                 format.validate()
 
+    def test_tsv_taxonomy_format_bom_and_line_endings(self):
+        filepath = os.path.join(self.temp_dir.name, 'taxonomy.tsv')
+        for contents in [b'\xef\xbb\xbfFeature ID\tTaxon\nseq1\tk__Bacteria\n',
+                         b'Feature ID\tTaxon\r\nseq1\tk__Bacteria\r\n',
+                         b'Feature ID\tTaxon\rseq1\tk__Bacteria\r']:
+            with open(filepath, 'wb') as fh:
+                fh.write(contents)
+
+            self.assertTrue(TaxonomyFormat(filepath, mode='r').sniff())
+            TSVTaxonomyFormat(filepath, mode='r').validate()
+
+    def test_tsv_taxonomy_format_invalid_utf8(self):
+        filepath = os.path.join(self.temp_dir.name, 'taxonomy.tsv')
+        with open(filepath, 'wb') as fh:
+            fh.write(b'Feature ID\tTaxon\nseq1\t\xff\xfe\n')
+
+        self.assertFalse(TaxonomyFormat(filepath, mode='r').sniff())
+        format = TSVTaxonomyFormat(filepath, mode='r')
+        with self.assertRaisesRegex(ValidationError,
+                                    'cannot decode byte on line 2'):
+            format.validate()
+
+    def test_tsv_taxonomy_format_min_reads_a_prefix(self):
+        # The undecodable last line is past what 'min' may read, so 'min'
+        # only passes if it stops reading after the first records.
+        filepath = os.path.join(self.temp_dir.name, 'taxonomy.tsv')
+        with open(filepath, 'wb') as fh:
+            fh.write(b'Feature ID\tTaxon\n')
+            fh.write(b'seq1\tk__Bacteria\n' * 100000)
+            fh.write(b'seq2\t\xff\xfe\n')
+
+        format = TSVTaxonomyFormat(filepath, mode='r')
+        format.validate(level='min')
+        with self.assertRaisesRegex(ValidationError,
+                                    'cannot decode byte on line 100002'):
+            format.validate()
+
 
 class TestNucleicAcidFASTAFormats(TestPluginBase):
     package = 'q2_types.feature_data.tests'
@@ -193,6 +235,30 @@ class TestNucleicAcidFASTAFormats(TestPluginBase):
 
         format.validate()
 
+    def test_dna_fasta_format_byte_order_mark_on_sequence_line(self):
+        filepath = os.path.join(self.temp_dir.name, 'dna-sequences.fasta')
+        with open(filepath, 'wb') as fh:
+            fh.write(b'>a\n\xef\xbb\xbfACGT\n>b\nACGT\n')
+
+        DNAFASTAFormat(filepath, mode='r').validate()
+        AlignedDNAFASTAFormat(filepath, mode='r').validate()
+
+    def test_dna_fasta_format_long_sequence_lines(self):
+        # Long enough to be checked with numba, if it is installed.
+        filepath = os.path.join(self.temp_dir.name, 'dna-sequences.fasta')
+        sequence = 'ACGT' * 2048
+        with open(filepath, 'w') as fh:
+            fh.write(f'>a\n{sequence}\n>b\n{sequence}\n')
+
+        DNAFASTAFormat(filepath, mode='r').validate(level='min')
+
+        with open(filepath, 'w') as fh:
+            fh.write(f'>a\n{sequence}\n>b\n{sequence}1\n')
+
+        with self.assertRaisesRegex(ValidationError, "Invalid character '1' "
+                                                     ".*8192 on line 4"):
+            DNAFASTAFormat(filepath, mode='r').validate()
+
     def test_dna_fasta_format_invalid_characters(self):
         filepath = self.get_data_path('not-dna-sequences.fasta')
         format = DNAFASTAFormat(filepath, mode='r')
@@ -301,6 +367,39 @@ class TestNucleicAcidFASTAFormats(TestPluginBase):
                                     'line 4.*length 88.*length 64'):
             format.validate()
 
+    def _validate_across_blocks(self):
+        # Blocks of a single line (or part of one) and of several lines, with
+        # numba's chunk boundaries in the middle of lines.
+        for block_size in (1, 16):
+            with mock.patch('q2_types._util._VECTORIZED_BLOCK_SIZE',
+                            block_size), \
+                    mock.patch('q2_types._util._JIT_MIN_BLOCK_SIZE', 0), \
+                    mock.patch('q2_types._util._JIT_CHUNK_SIZE', 3):
+                AlignedDNAFASTAFormat(
+                    self.get_data_path('aligned-dna-sequences.fasta'),
+                    mode='r').validate()
+
+                format = DNAFASTAFormat(
+                    self.get_data_path('dna-sequences-duplicate-id.fasta'),
+                    mode='r')
+                with self.assertRaisesRegex(ValidationError,
+                                            '3.*duplicate.*1'):
+                    format.validate()
+
+                format = DNAFASTAFormat(
+                    self.get_data_path('not-dna-sequences.fasta'), mode='r')
+                with self.assertRaisesRegex(ValidationError,
+                                            "Invalid character '1' .*0 on "
+                                            "line 2"):
+                    format.validate()
+
+    def test_dna_fasta_format_vectorized_across_blocks(self):
+        self._validate_across_blocks()
+
+    def test_dna_fasta_format_vectorized_across_blocks_without_numba(self):
+        with mock.patch('q2_types._util._NUMBA_AVAILABLE', False):
+            self._validate_across_blocks()
+
     def test_aligned_dna_sequences_directory_format(self):
         filepath = self.get_data_path('aligned-dna-sequences.fasta')
         temp_dir = self.temp_dir.name
@@ -702,6 +801,80 @@ class TestNucleicAcidFASTAFormats(TestPluginBase):
             format.validate()
 
 
+@unittest.skipUnless(importlib.util.find_spec('numba'),
+                     'numba is not installed')
+class TestJITKernels(TestPluginBase):
+    package = 'q2_types.feature_data.tests'
+
+    def setUp(self):
+        super().setUp()
+        from q2_types import _jit
+        self.jit = _jit
+        self.table = np.zeros(256, dtype=np.uint8)
+        self.table[list(b'ACGT\n')] = 1
+
+    def _starts_in_description(self, block, chunk_size):
+        # Whether the line holding the first byte of each chunk is a
+        # description.
+        in_description = []
+        line_start = 0
+        for i in range(block.size):
+            if i and block[i - 1] == ord('\n'):
+                line_start = i
+            in_description.append(block[line_start] == ord('>'))
+        return np.array(in_description[::chunk_size], dtype=np.bool_)
+
+    def test_validate_bytes_against_table(self):
+        for size in (0, 1, 4095, 4096, 4097, 10000):
+            buf = np.frombuffer(b'ACGT' * (size // 4) + b'A' * (size % 4),
+                                dtype=np.uint8)
+            self.assertEqual(
+                self.jit.validate_bytes_against_table(buf, self.table), -1)
+
+            for position in {0, size // 2, size - 1} if size else ():
+                bad = buf.copy()
+                bad[position] = ord('N')
+                self.assertEqual(
+                    self.jit.validate_bytes_against_table(bad, self.table),
+                    position)
+
+    def test_find_disallowed_sequence_byte(self):
+        block = np.frombuffer(b'>s1 N\nACGT\nAC\n>s2 NN\nGGNT\n>s3\nT\n',
+                              dtype=np.uint8)
+        expected = block.tobytes().index(b'GGNT') + 2
+        valid = block.copy()
+        valid[expected] = ord('A')
+
+        for chunk_size in range(1, block.size + 1):
+            starts_in_description = self._starts_in_description(
+                block, chunk_size)
+            self.assertEqual(
+                self.jit.find_disallowed_sequence_byte(
+                    block, self.table, chunk_size, starts_in_description),
+                expected)
+            self.assertEqual(
+                self.jit.find_disallowed_sequence_byte(
+                    valid, self.table, chunk_size, starts_in_description),
+                -1)
+
+    def test_parallel_scan_from_several_threads(self):
+        def validate(filename):
+            format = DNAFASTAFormat(self.get_data_path(filename), mode='r')
+            try:
+                format.validate()
+            except ValidationError as e:
+                return str(e)
+
+        filenames = ['dna-sequences.fasta', 'not-dna-sequences.fasta'] * 8
+        with mock.patch('q2_types._util._JIT_MIN_BLOCK_SIZE', 0), \
+                mock.patch('q2_types._util._JIT_CHUNK_SIZE', 3):
+            expected = [validate(filename) for filename in filenames]
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                observed = list(executor.map(validate, filenames))
+
+        self.assertEqual(observed, expected)
+
+
 class TestDifferentialFormat(TestPluginBase):
     package = 'q2_types.feature_data.tests'
 
@@ -754,6 +927,31 @@ class TestDifferentialFormat(TestPluginBase):
             format = DifferentialDirectoryFormat(temp_dir, mode='r')
             format.validate()
 
+    def test_differential_format_types_directive(self):
+        filepath = os.path.join(self.temp_dir.name, 'differentials.tsv')
+        with open(filepath, 'w') as fh:
+            fh.write('featureid\teffect\n#q2:types\tnumeric\nF0\t-0.9\n'
+                     'F1\t1.01\n')
+        format = DifferentialDirectoryFormat(self.temp_dir.name, mode='r')
+        format.validate()
+
+        with open(filepath, 'w') as fh:
+            fh.write('featureid\teffect\n#q2:types\tcategorical\nF0\t-0.9\n'
+                     'F1\t1.01\n')
+        with self.assertRaisesRegex(ValidationError, 'numeric'):
+            format = DifferentialDirectoryFormat(self.temp_dir.name,
+                                                 mode='r')
+            format.validate()
+
+        # More types than there are columns
+        with open(filepath, 'w') as fh:
+            fh.write('featureid\teffect\n#q2:types\tnumeric\tnumeric\n'
+                     'F0\t-0.9\nF1\t1.01\n')
+        with self.assertRaises(ValidationError):
+            format = DifferentialDirectoryFormat(self.temp_dir.name,
+                                                 mode='r')
+            format.validate()
+
 
 class TestProteinFASTAFormats(TestPluginBase):
     package = 'q2_types.feature_data.tests'
@@ -902,6 +1100,31 @@ class TestBLAST6Format(TestPluginBase):
         with self.assertRaisesRegex(ValidationError, 'Invalid BLAST6 format.'):
             BLAST6DirectoryFormat(temp_dir, mode='r').validate()
 
+    def test_blast6_format_min(self):
+        temp_dir = self.temp_dir.name
+        shutil.copy(self.get_data_path('blast6.tsv'),
+                    os.path.join(temp_dir, 'blast6.tsv'))
+        BLAST6DirectoryFormat(temp_dir, mode='r').validate(level='min')
+
+        shutil.copy(self.get_data_path('blast6_invalid.tsv'),
+                    os.path.join(temp_dir, 'blast6.tsv'))
+        with self.assertRaisesRegex(ValidationError, 'Invalid BLAST6 format.'):
+            BLAST6DirectoryFormat(temp_dir, mode='r').validate(level='min')
+
+    def test_blast6_format_min_reads_a_prefix(self):
+        # As for taxonomy, 'min' only passes if it never reads as far as the
+        # undecodable last record.
+        temp_dir = self.temp_dir.name
+        with open(self.get_data_path('blast6.tsv'), 'rb') as fh:
+            record = fh.readline()
+        with open(os.path.join(temp_dir, 'blast6.tsv'), 'wb') as fh:
+            fh.write(record * 10000)
+            fh.write(record.replace(b'moaC', b'\xff\xfe'))
+
+        BLAST6DirectoryFormat(temp_dir, mode='r').validate(level='min')
+        with self.assertRaises(ValidationError):
+            BLAST6DirectoryFormat(temp_dir, mode='r').validate()
+
 
 class TestSequenceCharacteristicsFormat(TestPluginBase):
     package = 'q2_types.feature_data.tests'